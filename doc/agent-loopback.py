@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Loopback check for agent mode. Starts an agent on 127.0.0.1 with an HTTP GET controller pointing at a small local web server, sends it a batch, and checks the reply and that the command reached the web server.
+
+    doc/agent-loopback.py
+
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import secrets
+import tempfile
+import threading
+import subprocess
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from multiprocessing.connection import Client
+
+video_route = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "video-route.py")
+
+
+def free_port():
+    """
+    Find an unused local TCP port
+
+    :return: returns port number
+    """
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+# Web server standing in for a device
+received = []
+class DeviceHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        received.append(self.path)
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+device = HTTPServer(("127.0.0.1", 0), DeviceHandler)
+threading.Thread(target=device.serve_forever, daemon=True).start()
+
+config = {
+    "video_controllers":{
+        "dev":{
+            "name":"Loopback Device",
+            "type":"http_get",
+            "ip":f"127.0.0.1:{device.server_address[1]}",
+            "uri":"/?cmd="
+        }
+    },
+    "sources":{}
+}
+
+with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as configfile:
+    json.dump(config, configfile)
+
+port = free_port()
+key = secrets.token_hex(16)
+env = dict(os.environ, VIDEO_ROUTE_AGENT_KEY=key)
+result = 1
+
+try:
+    # Agent must refuse to start without a key
+    no_key = dict(os.environ)
+    no_key.pop("VIDEO_ROUTE_AGENT_KEY", None)
+    refused = subprocess.run([sys.executable, video_route, "-a", "-p", str(port), "-c", configfile.name], env=no_key, capture_output=True, timeout=30)
+    assert refused.returncode == 1, "Agent started without a key"
+
+    agent = subprocess.Popen([sys.executable, video_route, "-a", "-p", str(port), "-c", configfile.name, "--probe-interval", "0"], env=env)
+    try:
+        conn = None
+        for attempt in range(50):
+            try:
+                conn = Client(("127.0.0.1", port), authkey=bytes(key, "utf-8"))
+                break
+            except ConnectionRefusedError:
+                time.sleep(0.2)
+        assert conn is not None, "Could not connect to agent"
+
+        conn.send(("ping", 1.0))
+        assert conn.poll(10), "No pong from agent"
+        pong = conn.recv()
+        assert pong[:2] == ("pong", 1.0) and isinstance(pong[2], dict), f"Unexpected pong {pong}"
+
+        conn.send(("batch", 1, [("dev", ["hello"]), ("missing", ["x"])]))
+        assert conn.poll(10), "No reply to batch"
+        reply = conn.recv()
+        assert reply[0] == "done" and reply[1] == 1, f"Unexpected reply {reply}"
+        assert reply[2] == ["No video controller [missing]"], f"Unexpected errors {reply[2]}"
+        assert received == ["/?cmd=hello"], f"Device received {received}"
+        conn.close()
+
+        print("Agent loopback passed")
+        result = 0
+    finally:
+        agent.terminate()
+        agent.wait()
+finally:
+    os.unlink(configfile.name)
+    device.shutdown()
+
+sys.exit(result)
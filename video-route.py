@@ -16,9 +16,19 @@ import re
 import os
 import time
 import json
-from pprint import pprint
+import socket
+import hashlib
+import pickle
+import tempfile
+from urllib.parse import quote
+from urllib.error import HTTPError
 import asyncio
 import signal
+import threading
+import queue
+import logging
+import logging.handlers
+import atexit
 from multiprocessing import Process
 
 
@@ -41,6 +51,225 @@ json_codes = {
     "#ESC":"\x1b"
 }
 
+# Icon sizes generated for srcset, these match the max-width and max-height of images in style.css
+icon_sizes = {
+    "1x":(300,100),
+    "2x":(600,200)
+}
+
+# Properties each video controller type must have, also used as the list of valid types when checking configs
+controller_properties = {
+    "serial":["serial","baud","parity"],
+    "telnet":["ip"],
+    "http_get":["ip","uri"],
+    "atem":["ip"],
+    "obs":["ip","port","password","timeout"],
+    "remote":["ip","port","controller"]
+}
+
+# Seconds to wait for a device to respond to a health probe
+probe_timeout = 2
+
+# Maximum number of command lists to hold for a device that is down when it is set to queue them
+probe_queue_limit = 20
+
+# Controller types that take commands as a list of strings, the others take a list of function dicts
+controller_string_cmds = ["serial","telnet","http_get"]
+
+# Properties sources use for the web interface, any other property must be a video controller key
+source_properties = ["name","description","color","background","icon","hide","sources"]
+
+# Compiled configs are pickled with this version and will not be loaded by a version that doesn't match
+compiled_version = 1
+
+# Structure of config files, checked with the jsonschema module if it is installed
+config_schema = {
+    "type":"object",
+    "required":["video_controllers","sources"],
+    "properties":{
+        "video_controllers":{
+            "type":"object",
+            "additionalProperties":{
+                "type":"object",
+                "required":["type"],
+                "properties":{
+                    "name":{"type":"string"},
+                    "type":{"enum":list(controller_properties)},
+                    "cmd_delay":{"type":"number","minimum":0},
+                    "timeout":{"type":"number","minimum":0},
+                    "when_down":{"enum":["fail","queue"]},
+                    "cmd_init":{"type":"array"}
+                }
+            }
+        },
+        "sources":{"$ref":"#/$defs/sources"}
+    },
+    "$defs":{
+        "sources":{
+            "type":"object",
+            "additionalProperties":{
+                "type":"object",
+                "properties":{
+                    "name":{"type":"string"},
+                    "description":{"type":"string"},
+                    "color":{"type":"string"},
+                    "background":{"type":"string"},
+                    "icon":{"type":["string","null"]},
+                    "hide":{"type":"boolean"},
+                    "sources":{"$ref":"#/$defs/sources"}
+                }
+            }
+        }
+    }
+}
+
+# Logging goes through a queue to a background thread so writing to stdout or journald doesn't block requests
+log = logging.getLogger("video-route")
+log_settings = {"level":"INFO","json_output":False}
+log_listener = None
+
+# Loggers from Flask and werkzeug write per-request lines, they are sent through the same queue and only shown when debugging
+web_loggers = ["werkzeug","Video Route"]
+
+# Map of id of each video controller config to its key, filled when the config is loaded, used to name controller loggers
+controller_keys = {}
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Log formatter that outputs each record as a single line JSON object
+    """
+
+    def format(self,record):
+        """
+        Format log record as JSON
+
+        :param record: Log record to format
+        :return: returns JSON string
+        """
+        data={
+            "time":self.formatTime(record),
+            "level":record.levelname,
+            "logger":record.name,
+            "message":record.getMessage()
+        }
+        if record.exc_info:
+            data["exception"]=self.formatException(record.exc_info)
+        return json.dumps(data)
+
+
+def setup_logging(level=None,json_output=None):
+    """
+    Configure logging output and start the background thread that writes it. Must be called again in new processes because the thread is not copied to them.
+
+    :param level: Log level name, uses previous value if not provided
+    :param json_output: Output logs as JSON instead of text, uses previous value if not provided
+    :return: returns nothing
+    """
+    global log_listener
+    if level is not None:
+        log_settings["level"]=level.upper()
+    if json_output is not None:
+        log_settings["json_output"]=json_output
+
+    handler = logging.StreamHandler()
+    if log_settings["json_output"]:
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    for logger in [log]+[logging.getLogger(name) for name in web_loggers]:
+        logger.handlers = [queue_handler]
+        logger.propagate = False
+    set_log_level(log_settings["level"])
+
+    if log_listener is None:
+        atexit.register(lambda: log_listener.stop())
+    log_listener = logging.handlers.QueueListener(log_queue, handler)
+    log_listener.start()
+
+
+def set_log_level(level):
+    """
+    Set log level for this program. Web server access lines are only logged at the DEBUG level.
+
+    :param level: Log level name or number
+    :return: returns nothing
+    """
+    log.setLevel(level)
+    for name in web_loggers:
+        logging.getLogger(name).setLevel(logging.DEBUG if log.level == logging.DEBUG else max(log.level, logging.WARNING))
+
+
+def toggle_debug(sig, frame):
+    """
+    Switch between debug logging and the configured log level. Used as a signal handler so debug output can be turned on without restarting.
+
+    :return: returns nothing
+    """
+    if log.level == logging.DEBUG:
+        set_log_level(log_settings["level"])
+    else:
+        set_log_level(logging.DEBUG)
+    log.warning(f"Log level set to [{logging.getLevelName(log.level)}]")
+
+
+def controller_log(config):
+    """
+    Get logger for a video controller so output from each device can be filtered separately.
+
+    :param config: Device controller configuration
+    :return: returns logger named after the controller key
+    """
+    key=controller_keys.get(id(config))
+    if key is None:
+        key=config["name"] if "name" in config else config["type"]
+    # Dots would make a nested logger
+    return log.getChild("controller."+key.replace(".","_"))
+
+
+def device_unreachable(error):
+    """
+    Check if an exception from sending commands means the device couldn't be reached, as opposed to the device rejecting a command. Only these should mark a device as down.
+
+    :param error: Exception raised while sending commands
+    :return: returns True for connection and timeout errors
+    """
+    return isinstance(error, (OSError, EOFError, asyncio.TimeoutError)) and not isinstance(error, HTTPError)
+
+
+def probe_controller(config,timeout=probe_timeout):
+    """
+    Check if a video controller can be reached without sending it any commands. Network devices are checked by opening a connection and serial devices by checking the port exists.
+
+    :param config: Device controller configuration
+    :param timeout: Time in seconds to wait for the device
+    :return: returns nothing, raises exception if device can't be reached
+    """
+    match config["type"]:
+        case "serial":
+            path=serialByName(config["serial"])
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"No serial port [{path}]")
+        case "atem":
+            # ATEM uses UDP so needs its own handshake
+            switcher = PyATEMMax.ATEMMax()
+            switcher.ping(config["ip"], timeout)
+            connected=switcher.waitForConnection(infinite=False, timeout=timeout, waitForFullHandshake=False)
+            switcher.disconnect()
+            if not connected:
+                raise TimeoutError("No response from ATEM")
+        case _:
+            host=config["ip"]
+            port=config["port"] if "port" in config else 23
+            if config["type"] == "http_get":
+                host, _, port = config["ip"].partition(":")
+                port=port if port else 80
+            socket.create_connection((host,int(port)), timeout=timeout).close()
+
+
 def serialByName(name):
     """
     This is a wrapper to allow the user to specify serial devices by their USB name or ID and path.
@@ -70,7 +299,7 @@ def serialByName(name):
 
 
 
-async def telnet_commands(ip,cmds,skip=0,delay=0,port=23):
+async def telnet_commands(ip,cmds,skip=0,delay=0,port=23,timeout=10):
     """
     Generic telnet wrapper for use with multiple devices. This exists to wrap the async requirement but also so that a single connection can be established for all needed commands.
 
@@ -80,24 +309,566 @@ async def telnet_commands(ip,cmds,skip=0,delay=0,port=23):
     :param skip: Number of lines to read and discard when connecting to server before issuing commands
     :param delay: Time in seconds to wait before sending next command
     :param port: Port for telnet server
+    :param timeout: Time in seconds to wait for connection and for each response
     :return: returns response from last command
     """
-    reader, writer = await telnetlib3.open_connection(ip, 23)
+    reader, writer = await asyncio.wait_for(telnetlib3.open_connection(ip, port), timeout)
 
-    while skip:
-        inp = await reader.readuntil()
-        skip-=1
+    try:
+        while skip:
+            inp = await asyncio.wait_for(reader.readuntil(), timeout)
+            skip-=1
+
+        response = None
+        for cmd in cmds:
+            cmd = escape_codes(cmd)
+            writer.write(cmd)
+            response = await asyncio.wait_for(reader.readuntil(), timeout)
+            log.debug("Telnet [%s] response: %s", ip, response.decode("ascii").strip())
+            time.sleep(delay)
+    finally:
+        writer.close()
+
+    return response.decode("ascii") if response is not None else None
+
+
+def escape_codes(cmd):
+    """
+    Replace substitute escape sequences from `json_codes` in a command.
 
-    response = None
+    :param cmd: Command string from config
+    :return: returns command with escape sequences replaced
+    """
+    for key, value in json_codes.items():
+        cmd = cmd.replace(key,value)
+    return cmd
+
+
+def check_config(config):
+    """
+    Validate config file data. The structure is checked against `config_schema` if the jsonschema module is installed, then every video controller and source is checked to make sure commands will go somewhere.
+
+    :param config: Config data loaded from JSON
+    :return: returns list of error strings, empty if config is valid
+    """
+    errors=[]
+    schema_checked=False
+    try:
+        import jsonschema
+        validator=jsonschema.Draft202012Validator(config_schema)
+        for error in validator.iter_errors(config):
+            path=" > ".join(str(part) for part in error.absolute_path)
+            errors.append(f'[{path}] {schema_message(error)}')
+        schema_checked=True
+    except ImportError as e:
+        log.warning("Python module [jsonschema] not installed, skipping schema validation")
+
+    # Basic structure is checked here when jsonschema isn't available to do it
+    if not isinstance(config, dict):
+        return errors if schema_checked else ["Config must be a JSON object"]
+    missing=[prop for prop in config_schema["required"] if not isinstance(config.get(prop), dict)]
+    if missing:
+        if not schema_checked:
+            for prop in missing:
+                errors.append(f'[{prop}] Missing or not a JSON object')
+        return errors
+    controllers=config["video_controllers"]
+
+    for key, value in controllers.items():
+        if not isinstance(value, dict) or value.get("type") not in controller_properties:
+            if not schema_checked:
+                errors.append(f'[video_controllers > {key}] Unknown controller type [{value.get("type") if isinstance(value, dict) else value}]')
+            continue
+        for prop in controller_properties[value["type"]]:
+            if prop not in value:
+                errors.append(f'[video_controllers > {key}] Missing property [{prop}] for type [{value["type"]}]')
+        # The schema already reports cmd_init that isn't a list
+        if "cmd_init" in value and (isinstance(value["cmd_init"], list) or not schema_checked):
+            errors+=check_commands(value["cmd_init"],value["type"],f'video_controllers > {key} > cmd_init')
+
+    def check_sources(sources,path):
+        if not isinstance(sources, dict):
+            return
+        for key, value in sources.items():
+            if not isinstance(value, dict):
+                continue
+            for prop, cmds in value.items():
+                if prop == "sources":
+                    check_sources(cmds,f'{path} > {key} > sources')
+                elif prop in controllers:
+                    if isinstance(controllers[prop], dict) and controllers[prop].get("type") in controller_properties:
+                        errors.extend(check_commands(cmds,controllers[prop]["type"],f'{path} > {key} > {prop}'))
+                elif prop not in source_properties:
+                    errors.append(f'[{path} > {key}] Unknown property [{prop}] is not a video controller')
+
+    check_sources(config["sources"],"sources")
+    return errors
+
+
+def schema_message(error):
+    """
+    Short description of a jsonschema error. The default messages include the failing value which can be an entire source list.
+
+    :param error: ValidationError from jsonschema
+    :return: returns error message string
+    """
+    match error.validator:
+        case "type":
+            return f'Must be of type [{error.validator_value}]'
+        case "enum":
+            return f'Must be one of {error.validator_value}'
+        case "minimum":
+            return f'Must be at least [{error.validator_value}]'
+    return error.message
+
+
+def check_commands(cmds,controller_type,path):
+    """
+    Check a command list matches what its video controller type expects.
+
+    :param cmds: Command list from config
+    :param controller_type: Type of the video controller the commands are sent to
+    :param path: Location of the commands in the config for error messages
+    :return: returns list of error strings
+    """
+    if not isinstance(cmds, list):
+        return [f'[{path}] Commands must be a list']
+    # Remote commands are checked by the agent that runs them
+    if controller_type == "remote":
+        return []
+    expected=str if controller_type in controller_string_cmds else dict
     for cmd in cmds:
-        for key, value in json_codes.items():
-            cmd = cmd.replace(key,value)
-        writer.write(cmd)
-        response = await reader.readuntil()
-        print(response.decode("ascii"))
-        time.sleep(delay)
+        if not isinstance(cmd, expected):
+            return [f'[{path}] Commands for type [{controller_type}] must be {"strings" if expected is str else "function dicts"}']
+    return []
+
+
+def resolve_source(source, config, controllers):
+    """
+    Find all commands run by a source. Walks nested sources the same way as a click from the web interface so commands on parent groups are included.
+
+    :param source: Delimited source identifier string
+    :param config: Source list from config
+    :param controllers: Video controllers from config
+    :return: returns list of (controller key, commands) tuples in the order they are run
+    """
+    resolved=[]
+    if source.split("|")[0] in config:
+        for key, value in config[source.split("|")[0]].items():
+
+            if isinstance(value, dict):
+                resolved+=resolve_source(source[len(source.split("|")[0])+1:], value, controllers)
+
+            if key in controllers and isinstance(controllers[key], dict) and controllers[key].get("type") in controller_properties:
+                resolved.append((key,value))
+    return resolved
+
+
+def compile_config(config):
+    """
+    Precompile config into a dispatch table mapping every source identifier to the commands it runs, with escape codes already replaced. The result can be pickled and loaded in place of a JSON config.
+
+    :param config: Validated config data loaded from JSON
+    :return: returns dict with version, config, and dispatch table
+    """
+    controllers=config["video_controllers"]
+
+    def source_ids(sources,prefix=""):
+        ids=[]
+        for key, value in sources.items():
+            ids.append(prefix+key)
+            if isinstance(value, dict) and isinstance(value.get("sources"), dict):
+                ids+=source_ids(value["sources"],prefix+key+"|")
+        return ids
+
+    dispatch={}
+    for source in source_ids(config["sources"]):
+        dispatch[source]=[]
+        for key, cmds in resolve_source(source, config["sources"], controllers):
+            if controllers[key]["type"] in controller_string_cmds:
+                cmds=[escape_codes(cmd) for cmd in cmds]
+            dispatch[source].append((key,cmds))
+
+    return {
+        "version":compiled_version,
+        "config":config,
+        "dispatch":dispatch
+    }
+
+
+class Recorder(object):
+    """
+    Records timestamped events to a JSON lines file for replaying later. Events are written from a background thread so recording doesn't slow down requests.
+
+    The first line is a header with the format version and start time. Requests from the web interface are written as `{"t":time,"s":source}` and commands sent to video controllers as `{"t":time,"c":controller,"n":command count,"w":time waiting for the controller,"d":duration}`, with times in seconds from the start of the recording.
+    """
+
+    def __init__(self,path):
+        """
+        Construct a new 'Recorder' object and start writing to the file.
+
+        :param path: Path of file to record to, will be overwritten
+        :return: returns nothing
+        """
+        self.path = path
+        self.start = time.monotonic()
+        self.queue = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def event(self,**data):
+        """
+        Queue an event to be written with the current time.
+
+        :param data: Values to record for the event
+        :return: returns nothing
+        """
+        data["t"]=round(time.monotonic()-self.start,4)
+        self.queue.put(data)
+
+    def run(self):
+        """
+        Write queued events to file
+
+        :return: returns nothing
+        """
+        with open(self.path, 'w') as recordfile:
+            recordfile.write(json.dumps({"v":1,"start":time.time()})+"\n")
+            while True:
+                data=self.queue.get()
+                recordfile.write(json.dumps(data, separators=(",",":"))+"\n")
+                # Flush whenever caught up so the file is usable if the process is terminated
+                if self.queue.empty():
+                    recordfile.flush()
+
+
+class ControllerHealth(object):
+    """
+    Circuit breaker for a video controller. A background thread probes the device so commands for a device that is down fail right away, or are queued until it comes back, instead of each one waiting for a connection timeout.
+
+    Devices start as `unknown` and become `up` or `down` after the first probe. A device is also marked `down` as soon as sending commands to it fails.
+    """
+
+    def __init__(self,server,key,interval=10):
+        """
+        Construct a new 'ControllerHealth' object and start probing the device.
+
+        :param server: WebInterface the video controller belongs to
+        :param key: Key of the video controller in the config
+        :param interval: Time in seconds between probes
+        :return: returns nothing
+        """
+        self.server = server
+        self.key = key
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.state = "unknown"
+        self.since = time.time()
+        self.error = None
+        self.queue = []
+        self.dropped = 0
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def config(self):
+        """
+        Current config for the video controller, which can change when the config file is reloaded
+
+        :return: returns device controller configuration or None if it was removed
+        """
+        return self.server.config["video_controllers"].get(self.key)
+
+    def run(self):
+        """
+        Probe device until it is removed from the config
+
+        :return: returns nothing
+        """
+        while True:
+            config=self.config()
+            if config is None:
+                return
+            try:
+                probe_controller(config)
+                self.up()
+            except Exception as e:
+                self.down(repr(e))
+            time.sleep(self.interval)
+            if self.server.health.get(self.key) is not self:
+                return
+
+    def log(self):
+        """
+        Logger for the video controller
+
+        :return: returns controller logger, or main logger if the controller was removed from the config
+        """
+        config=self.config()
+        return controller_log(config) if config is not None else log
+
+    def up(self):
+        """
+        Mark device as reachable and send any commands queued while it was down
+
+        :return: returns nothing
+        """
+        with self.lock:
+            if self.state == "up" and not self.queue:
+                return
+
+        # Hold the send lock while flushing so new requests are sent after the queued commands
+        with self.server.controller_lock(self.key):
+            with self.lock:
+                if self.state != "up":
+                    self.log().info("Device is up")
+                    self.state="up"
+                    self.since=time.time()
+                    self.error=None
+                queued=self.queue
+                self.queue=[]
+
+            for cmds in queued:
+                self.server.send_controller(self.key,cmds)
+
+    def down(self,error):
+        """
+        Mark device as unreachable
+
+        :param error: Reason the device is down
+        :return: returns nothing
+        """
+        with self.lock:
+            if self.state != "down":
+                self.log().warning("Device is down:" + error)
+                self.state="down"
+                self.since=time.time()
+            self.error=error
+
+    def allow(self,cmds):
+        """
+        Check if commands can be sent to the device. Commands for a device that is down are dropped, or queued if the controller has `"when_down":"queue"`.
+
+        :param cmds: Commands that will be sent
+        :return: returns True if commands should be sent now
+        """
+        with self.lock:
+            if self.state != "down":
+                return True
+
+            config=self.config()
+            if config is not None and config.get("when_down") == "queue":
+                self.queue.append(cmds)
+                if len(self.queue) > probe_queue_limit:
+                    self.queue.pop(0)
+                    self.dropped+=1
+                self.log().info("Device is down, queued commands")
+            else:
+                self.dropped+=1
+                self.log().warning("Device is down, skipped commands")
+            return False
+
+    def status(self):
+        """
+        Current health of the device
+
+        :return: returns dict of state, time of last change, error, and queued and dropped counts
+        """
+        config=self.config()
+        return {
+            "name":config["name"] if config is not None and "name" in config else self.key,
+            "state":self.state,
+            "since":self.since,
+            "error":self.error,
+            "queued":len(self.queue),
+            "dropped":self.dropped
+        }
+
+
+class RemoteAgent(object):
+    """
+    Persistent connection to a video-route agent running on another host. Commands are queued and sent from a background thread so a slow network doesn't hold up the web interface. Everything queued while a batch is being sent goes out together as the next batch, and batches are sent without waiting for the previous one to finish.
+    """
+
+    def __init__(self,ip,port,key,ping=5):
+        """
+        Construct a new 'RemoteAgent' object and start connecting to it.
+
+        :param ip: IP the agent is listening on
+        :param port: Port the agent is listening on
+        :param key: Shared key used to authenticate with the agent
+        :param ping: Time in seconds between health checks when no commands are sent
+        :return: returns nothing
+        """
+        self.address = (ip,int(port))
+        self.key = key
+        self.ping = ping
+        self.pid = os.getpid()
+        self.queue = queue.Queue()
+        self.pending = {}
+        self.seq = 0
+        self.closing = False
+
+        # Health information, health has the status of each controller as reported by the agent
+        self.state = "unknown"
+        self.health = {}
+        self.dropped = {}
+        self.connected = False
+        self.latency = None
+        self.batch_time = None
+        self.last_seen = None
+        self.batches = 0
+        self.errors = 0
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def send(self,controller,cmds):
+        """
+        Queue commands to send to a controller on the agent. The oldest commands are dropped if too many build up while the agent can't be reached.
+
+        :param controller: Key of the video controller in the agent's config
+        :param cmds: Commands as list to send
+        :return: returns nothing
+        """
+        while self.queue.qsize() >= probe_queue_limit:
+            try:
+                dropped=self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if dropped is not None:
+                self.dropped[dropped[0]]=self.dropped.get(dropped[0],0)+1
+        self.queue.put((controller,cmds))
+
+    def controller_state(self,controller):
+        """
+        State of a controller on the agent. Uses the health reported by the agent while connected.
+
+        :param controller: Key of the video controller in the agent's config
+        :return: returns `up`, `down`, or `unknown`
+        """
+        if self.state != "up":
+            return self.state
+        return self.health.get(controller, {}).get("state", "up")
 
-    return response.decode("ascii")
+    def close(self):
+        """
+        Disconnect from the agent after sending everything already queued.
+
+        :return: returns nothing
+        """
+        self.closing=True
+        self.queue.put(None)
+
+    def status(self):
+        """
+        Current health of the agent connection
+
+        :return: returns dict of connection state, ping round trip and last batch run time in ms, and counters
+        """
+        return {
+            "address":f'{self.address[0]}:{self.address[1]}',
+            "connected":self.connected,
+            "state":self.state,
+            "latency":round(self.latency*1000,1) if self.latency is not None else None,
+            "batch_time":round(self.batch_time*1000,1) if self.batch_time is not None else None,
+            "last_seen":self.last_seen,
+            "queued":self.queue.qsize(),
+            "in_flight":len(self.pending),
+            "batches":self.batches,
+            "errors":self.errors
+        }
+
+    def run(self):
+        """
+        Connect to the agent and send queued commands, reconnecting if the connection drops
+
+        :return: returns nothing
+        """
+        retry=1
+        while True:
+            try:
+                conn = Client(self.address, authkey=self.key)
+            except Exception as e:
+                self.connected=False
+                self.state="down"
+                log.error(f"Error connecting to agent [{self.address[0]}:{self.address[1]}]:" + repr(e))
+                if self.closing:
+                    return
+                time.sleep(retry)
+                retry=min(retry*2,30)
+                continue
+
+            retry=1
+            self.connected=True
+            self.state="up"
+            self.pending={}
+            threading.Thread(target=self.receive, args=(conn,), daemon=True).start()
+
+            batch=None
+            try:
+                while True:
+                    try:
+                        batch=[self.queue.get(timeout=self.ping)]
+                    except queue.Empty:
+                        conn.send(("ping",time.monotonic()))
+                        continue
+
+                    # Collect everything else that was queued into one batch
+                    while not self.queue.empty():
+                        batch.append(self.queue.get_nowait())
+
+                    # None is queued by close to stop after this batch
+                    stop=None in batch
+                    batch=[item for item in batch if item is not None]
+                    if batch:
+                        self.seq+=1
+                        self.pending[self.seq]=time.monotonic()
+                        conn.send(("batch",self.seq,batch))
+                    batch=None
+                    if stop:
+                        self.connected=False
+                        conn.close()
+                        return
+
+            except Exception as e:
+                self.connected=False
+                self.state="down"
+                log.error(f"Error with agent [{self.address[0]}:{self.address[1]}]:" + repr(e))
+                conn.close()
+                # Send unsent commands after reconnecting
+                if batch is not None:
+                    for item in batch:
+                        self.queue.put(item)
+                if self.closing:
+                    return
+
+    def receive(self,conn):
+        """
+        Read replies from the agent to track ping round trip time, how long batches take to run, and errors
+
+        :param conn: Connection to agent
+        :return: returns nothing
+        """
+        try:
+            while True:
+                msg = conn.recv()
+                self.last_seen=time.time()
+                match msg[0]:
+                    case "pong":
+                        self.latency=time.monotonic()-msg[1]
+                        if len(msg) > 2:
+                            self.health=msg[2]
+                    case "done":
+                        self.batch_time=time.monotonic()-self.pending.pop(msg[1],time.monotonic())
+                        self.batches+=1
+                        for error in msg[2]:
+                            self.errors+=1
+                            log.error(f"Error from agent [{self.address[0]}:{self.address[1]}]: {error}")
+        except Exception as e:
+            self.connected=False
+            self.state="down"
+            conn.close()
 
 
 class WebInterface(object):
@@ -128,12 +899,39 @@ class WebInterface(object):
         # Define routes in class to use with flask
         self.app.add_url_rule('/','home', self.index)
         self.app.add_url_rule('/system','system', self.web_system,methods=["POST"])
+        self.app.add_url_rule('/icon','icon', self.web_icon)
+        self.app.add_url_rule('/agents','agents', self.web_agents)
+        self.app.add_url_rule('/health','health', self.web_health)
 
         # Setup based on arguments
         self.host = args.ip
         self.port = args.port
         self.config_file = args.config
         self.config_init = args.reset_skip
+        # Replay mode mocks every video controller so their modules aren't needed
+        self.load_modules = args.replay is None
+        self.agent_key = bytes(args.agent_key,'utf-8') if args.agent_key else None
+        self.remote_agents = {}
+        self.remote_lock = threading.Lock()
+        self.record_file = args.record
+        self.recorder = None
+        self.probe_interval = args.probe_interval
+        self.health = {}
+        self.health_lock = threading.Lock()
+        self.probing = False
+        self.send_locks = {}
+
+        # Icon resizing is optional and falls back to serving the original file if Pillow is not available
+        self.icon_cache = args.icon_cache if args.icon_cache is not None else self.host_dir+"http/cache/icons"
+        self.icon_format = "webp" if args.icon_webp else None
+        self.icon_hashes = {}
+        try:
+            global Image
+            from PIL import Image
+            self.icon_resize = True
+        except Exception as e:
+            log.warning("Python module [Pillow] not installed, icons will be served at original size")
+            self.icon_resize = False
 
         # Define map for all supported device types for matching to JSON
         self.video_controllers = {}
@@ -142,6 +940,7 @@ class WebInterface(object):
         self.video_controllers["http_get"] = self.cmd_http_get
         self.video_controllers["atem"] = self.cmd_atem
         self.video_controllers["obs"] = self.cmd_obs
+        self.video_controllers["remote"] = self.cmd_remote
 
         # Module load information for each device type
         self.controller_modules = {}
@@ -149,6 +948,8 @@ class WebInterface(object):
             self.controller_modules[video_controller] = False
 
         # Initial config load
+        self.config_mtime = None
+        self.dispatch = None
         self.load_config()
 
 
@@ -164,12 +965,41 @@ class WebInterface(object):
         # Use instance file path if not provided
         if config_file is not None:
             self.config_file = config_file
+            self.config_mtime = None
 
         # If file exists, load it
         if self.config_file is not None and os.path.exists(self.config_file):
-            print("Reading from config")
-            with open(self.config_file, newline='') as jsonfile:
-                self.config=json.load(jsonfile)
+            # Skip reading if the file hasn't changed since the last load
+            mtime=os.path.getmtime(self.config_file)
+            if mtime == self.config_mtime:
+                return
+            self.config_mtime=mtime
+
+            log.info(f"Reading from config [{self.config_file}]")
+            with open(self.config_file, 'rb') as configfile:
+                data=configfile.read()
+
+            # Compiled configs are pickles and have already been checked
+            try:
+                if data[:1] == pickle.PROTO:
+                    compiled=pickle.loads(data)
+                    if compiled.get("version") != compiled_version:
+                        raise ValueError("Compiled config is from a different version, recompile it with --compile")
+                    config=compiled["config"]
+                    dispatch=compiled["dispatch"]
+                else:
+                    config=json.loads(data)
+                    dispatch=None
+                    for error in check_config(config):
+                        log.error(f"Config error {error}")
+            except Exception as e:
+                log.error(f"Error loading config [{self.config_file}]:" + repr(e))
+                # Can't run without a config at startup, otherwise keep using the last one that loaded
+                if not hasattr(self, "config"):
+                    sys.exit(1)
+                return
+            self.config=config
+            self.dispatch=dispatch
         else:
             # No file provided or did not exist, warn user on web interface
             self.config={
@@ -184,8 +1014,13 @@ class WebInterface(object):
                     }
             }
 
+        controller_keys.clear()
+        controller_keys.update({id(value):key for key, value in self.config["video_controllers"].items()})
+
         # Load modules for all defined device types in JSON config
         for key, value in self.config["video_controllers"].items():
+            if not self.load_modules or not isinstance(value, dict) or value.get("type") not in self.controller_modules:
+                continue
             if not self.controller_modules[value["type"]]:
                 match value["type"]:
                     case "serial":
@@ -221,6 +1056,12 @@ class WebInterface(object):
                         except Exception as e:
                             print("Need to install Python module [PyATEMMax]")
                             sys.exit(1)
+                    case "remote":
+
+                        global Client
+                        global Listener
+                        from multiprocessing.connection import Client, Listener
+                        self.controller_modules["remote"] = True
                     case "obs":
 
                         try:
@@ -234,11 +1075,14 @@ class WebInterface(object):
         # Skip initialization commands or not
         if not self.config_init:
             for key, value in self.config["video_controllers"].items():
-                if "cmd_init" in value:
+                if isinstance(value, dict) and "cmd_init" in value and value.get("type") in self.video_controllers:
                     self.video_controllers[value["type"]](value["cmd_init"],value)
 
             self.config_init=True
 
+        if self.probing:
+            self.start_health()
+
 
     async def start(self):
         """
@@ -246,8 +1090,12 @@ class WebInterface(object):
 
         :return: returns nothing
         """
-        print("Starting Flask")
-        self.web_thread = Process(target=self.app.run,
+        log.info(f"Starting Flask on [{self.host}:{self.port}]")
+        # Agents connected for cmd_init are closed so the web server process makes its own connections
+        for agent in self.remote_agents.values():
+            agent.close()
+        self.remote_agents={}
+        self.web_thread = Process(target=self.run_web,
             kwargs={
                 "host":self.host,
                 "port":self.port,
@@ -257,6 +1105,53 @@ class WebInterface(object):
             )
         self.web_thread.start()
 
+    def run_web(self,**kwargs):
+        """
+        Run Flask in the web server process after restarting logging for it
+
+        :param kwargs: Arguments for Flask run
+        :return: returns nothing
+        """
+        setup_logging()
+        self.start_health()
+        if self.record_file is not None:
+            log.info(f"Recording to [{self.record_file}]")
+            self.recorder = Recorder(self.record_file)
+        self.app.run(**kwargs)
+
+    def start_health(self):
+        """
+        Start health probes for all video controllers that don't have one yet. Probes for controllers removed from the config stop on their own.
+
+        Remote controllers are not probed because their agent connection already queues commands and reconnects, its state is reported instead.
+
+        :return: returns nothing
+        """
+        if not self.probe_interval:
+            return
+        self.probing=True
+        with self.health_lock:
+            for key in list(self.health):
+                if key not in self.config["video_controllers"]:
+                    del self.health[key]
+            for key, value in self.config["video_controllers"].items():
+                if not isinstance(value, dict) or value.get("type") not in self.video_controllers or value["type"] == "remote":
+                    continue
+                if key not in self.health:
+                    self.health[key]=ControllerHealth(self,key,self.probe_interval)
+
+    def controller_lock(self,key):
+        """
+        Lock held while sending commands to a video controller so devices only get one command list at a time and in order.
+
+        :param key: Key of the video controller in the config
+        :return: returns re-entrant lock for the controller
+        """
+        with self.health_lock:
+            if key not in self.send_locks:
+                self.send_locks[key]=threading.RLock()
+            return self.send_locks[key]
+
     def stop(self):
         """
         Stop web server in Process thread
@@ -273,22 +1168,24 @@ class WebInterface(object):
 
         :param cmds: Commands as list of strings to send
         :param config: Device controller configuration
-        :return: returns nothing
+        :return: returns False if the device could not be reached
         """
         line_end=config["line_end"] if "line_end" in config else ""
         cmd_delay=config["cmd_delay"] if "cmd_delay" in config else 0
+        clog=controller_log(config)
         try:
             serial_interface = serial.Serial(serialByName(config["serial"]),config["baud"],timeout=30,parity=config["parity"])
             for cmd in cmds:
-                for key, value in json_codes.items():
-                    cmd = cmd.replace(key,value)
-                serial_interface.write( bytes(cmd+line_end,'ascii',errors='ignore') )
-                print(bytes(cmd+line_end,'ascii',errors='ignore'))
+                cmd = escape_codes(cmd)
+                data=bytes(cmd+line_end,'ascii',errors='ignore')
+                serial_interface.write(data)
+                clog.debug("Sent %r", data)
                 time.sleep(cmd_delay)
 
         except Exception as e:
-            name=config["name"] if "name" in config else config["type"]
-            print(f"Error with device [{name}]:" + repr(e))
+            clog.error("Error with device:" + repr(e))
+            if device_unreachable(e):
+                return False
 
 
     def cmd_http_get(self,cmds,config):
@@ -297,21 +1194,21 @@ class WebInterface(object):
 
         :param cmds: Commands as list of strings to send
         :param config: Device controller configuration
-        :return: returns nothing
+        :return: returns False if the device could not be reached
         """
         cmd_delay=config["cmd_delay"] if "cmd_delay" in config else 0
         try:
             for cmd in cmds:
-                for key, value in json_codes.items():
-                    cmd = cmd.replace(key,value)
+                cmd = escape_codes(cmd)
                 endpoint=f'http://{config["ip"]}{config["uri"]}{cmd}'
                 req =  request_url.Request(endpoint)
-                resp = request_url.urlopen(req)
+                resp = request_url.urlopen(req, timeout=config["timeout"] if "timeout" in config else 10)
                 time.sleep(cmd_delay)
 
         except Exception as e:
-            name=config["name"] if "name" in config else config["type"]
-            print(f"Error with device [{name}]:" + repr(e))
+            controller_log(config).error("Error with device:" + repr(e))
+            if device_unreachable(e):
+                return False
 
 
     def cmd_telnet(self,cmds,config):
@@ -320,17 +1217,19 @@ class WebInterface(object):
 
         :param cmds: Commands as list of strings to send
         :param config: Device controller configuration
-        :return: returns nothing
+        :return: returns False if the device could not be reached
         """
         try:
             cmd_delay=config["cmd_delay"] if "cmd_delay" in config else 0
             port=config["port"] if "port" in config else 23
             connection_skip=config["connection_skip"] if "connection_skip" in config else 0
-            asyncio.run(telnet_commands(config["ip"],cmds,skip=connection_skip,delay=cmd_delay,port=port))
+            timeout=config["timeout"] if "timeout" in config else 10
+            asyncio.run(telnet_commands(config["ip"],cmds,skip=connection_skip,delay=cmd_delay,port=port,timeout=timeout))
 
         except Exception as e:
-            name=config["name"] if "name" in config else config["type"]
-            print(f"Error with device [{name}]:" + repr(e))
+            controller_log(config).error("Error with device:" + repr(e))
+            if device_unreachable(e):
+                return False
 
 
     def cmd_atem(self,cmds,config):
@@ -339,26 +1238,28 @@ class WebInterface(object):
 
         :param cmds: Commands as list of of dicts with function name as key and parameters as value
         :param config: Device controller configuration
-        :return: returns nothing
+        :return: returns False if the device could not be reached
         """
         cmd_delay=config["cmd_delay"] if "cmd_delay" in config else 0
         try:
             switcher = PyATEMMax.ATEMMax()
-            print(f'Atem Connect: {config["ip"]}')
+            controller_log(config).debug(f'Atem Connect: {config["ip"]}')
             switcher.connect(config["ip"])
-            switcher.waitForConnection()
+            if not switcher.waitForConnection(infinite=False, timeout=config["timeout"] if "timeout" in config else 10):
+                raise TimeoutError("No response from ATEM")
             for cmd in cmds:
                 for function, p in cmd.items():
                     if hasattr(switcher,function):
                         getattr(switcher,function)(*p)
                     else:
-                        print(f"Error with device [{name}]: OBS has no function [{function}]")
+                        controller_log(config).error(f"Error with device: ATEM has no function [{function}]")
                 time.sleep(cmd_delay)
             switcher.disconnect()
 
         except Exception as e:
-            name=config["name"] if "name" in config else config["type"]
-            print(f"Error with device [{name}]:" + repr(e))
+            controller_log(config).error("Error with device:" + repr(e))
+            if device_unreachable(e):
+                return False
 
 
     def cmd_obs(self,cmds,config):
@@ -367,32 +1268,143 @@ class WebInterface(object):
 
         :param cmds: Commands as list of of dicts with function name as key and parameters as value
         :param config: Device controller configuration
-        :return: returns nothing
+        :return: returns False if the device could not be reached
         """
         cmd_delay=config["cmd_delay"] if "cmd_delay" in config else 0
-        name=config["name"] if "name" in config else config["type"]
+        clog=controller_log(config)
         try:
             client = obs.ReqClient(host=config["ip"], port=config["port"], password=config["password"], timeout=config["timeout"])
             for cmd in cmds:
                 for function, p in cmd.items():
                     if hasattr(client,function):
-                        data =self.function_chain(client,function,p)
-                        if data is not None:
-                            pprint(getattr(data,data.attrs()[0]))
+                        data =self.function_chain(client,function,p,clog)
+                        if data is not None and clog.isEnabledFor(logging.DEBUG):
+                            clog.debug("%s returned: %s", function, getattr(data,data.attrs()[0]))
                     else:
-                        print(f"Error with device [{name}]: OBS has no function [{function}]")
+                        clog.error(f"Error with device: OBS has no function [{function}]")
                 time.sleep(cmd_delay)
 
         except Exception as e:
-            print(f"Error with device [{name}]:" + repr(e))
+            clog.error("Error with device:" + repr(e))
+            if device_unreachable(e):
+                return False
+
+
+    def cmd_remote(self,cmds,config):
+        """
+        Send commands to a controller attached to a video-route agent on another host. Commands are queued and this returns without waiting for the agent to run them.
+
+        If the agent can't be reached or reports the controller is down, commands are skipped unless the controller has `"when_down":"queue"`.
 
+        :param cmds: Commands as list to send, in the format the remote controller uses
+        :param config: Device controller configuration
+        :return: returns False if commands were skipped because the controller is down
+        """
+        address=(config["ip"],int(config["port"]))
+        with self.remote_lock:
+            # Connections are not shared with the web server process after it is started
+            if address not in self.remote_agents or self.remote_agents[address].pid != os.getpid():
+                key=bytes(config["key"],'utf-8') if "key" in config else self.agent_key
+                if not key:
+                    controller_log(config).error("No key for agent, add key to the controller or start with -k")
+                    return False
+                self.remote_agents[address]=RemoteAgent(config["ip"],config["port"],key)
+            agent=self.remote_agents[address]
+
+        if agent.controller_state(config["controller"]) == "down" and config.get("when_down") != "queue":
+            agent.dropped[config["controller"]]=agent.dropped.get(config["controller"],0)+1
+            controller_log(config).warning("Device is down, skipped commands")
+            return False
+        agent.send(config["controller"],cmds)
+
+
+    def serve_agent(self):
+        """
+        Run as an agent for another video-route instance. Listens for connections and runs commands on the local video controllers. Does not return.
+
+        :return: returns nothing
+        """
+        global Client
+        global Listener
+        from multiprocessing.connection import Client, Listener
+        self.start_health()
+        listener = Listener((self.host,int(self.port)), authkey=self.agent_key)
+        log.info(f"Agent listening on [{self.host}:{self.port}]")
+        while True:
+            try:
+                conn = listener.accept()
+            except Exception as e:
+                log.error("Error accepting agent connection:" + repr(e))
+                continue
+            threading.Thread(target=self.agent_connection, args=(conn,), daemon=True).start()
+
+
+    def agent_connection(self,conn):
+        """
+        Handle messages from a connected video-route instance. Pings are answered as soon as they arrive while batches are run in order on a separate thread, with a reply sent after each one.
 
-    def function_chain(self,client,function,p):
+        :param conn: Connection to video-route instance
+        :return: returns nothing
+        """
+        log.info("Agent client connected")
+        batches = queue.SimpleQueue()
+        send_lock = threading.Lock()
+
+        def reply(msg):
+            with send_lock:
+                conn.send(msg)
+
+        def run_batches():
+            while True:
+                msg = batches.get()
+                if msg is None:
+                    return
+                errors=[]
+                try:
+                    self.load_config()
+                    for key, cmds in msg[2]:
+                        controller=self.config["video_controllers"].get(key)
+                        if not isinstance(controller, dict) or controller.get("type") not in self.video_controllers:
+                            errors.append(f"No video controller [{key}]")
+                            continue
+                        if self.run_controller(key,cmds) is False:
+                            errors.append(f"Video controller [{key}] is down or could not be reached")
+                except Exception as e:
+                    log.error("Error running agent batch:" + repr(e))
+                    errors.append("Error running batch:" + repr(e))
+                try:
+                    reply(("done",msg[1],errors))
+                except Exception as e:
+                    return
+
+        threading.Thread(target=run_batches, daemon=True).start()
+        try:
+            while True:
+                msg = conn.recv()
+                if not isinstance(msg, tuple) or len(msg) < 2:
+                    raise ValueError(f"Malformed message {msg!r:.100}")
+                match msg[0]:
+                    case "ping":
+                        reply(("pong",msg[1],self.health_status()))
+                    case "batch" if len(msg) == 3:
+                        batches.put(msg)
+                    case _:
+                        raise ValueError(f"Malformed message {msg!r:.100}")
+        except (EOFError, OSError) as e:
+            log.info("Agent client disconnected")
+        except Exception as e:
+            log.error("Error with agent client:" + repr(e))
+        batches.put(None)
+        conn.close()
+
+
+    def function_chain(self,client,function,p,clog=log):
         """
         Recursively calls functions to pull data from client to build parent functions
 
         :param client: Base object functions will be called on
         :param function: base function
+        :param clog: Logger for the controller the client belongs to
         :return: returns retsult of function
         """
 
@@ -410,23 +1422,105 @@ class WebInterface(object):
                             attr=sub_function
                             for sub2_function, sub2_p in sub_p.items():
                                 call=sub2_function
-                                resp = self.function_chain(client,sub2_function,sub2_p)
+                                resp = self.function_chain(client,sub2_function,sub2_p,clog)
                         else:
                             # Return first attribute
                             call=sub_function
-                            resp = self.function_chain(client,sub_function,sub_p)
+                            resp = self.function_chain(client,sub_function,sub_p,clog)
                             attr=resp.attrs()[0]
                         processed.append(getattr(resp,attr))
-                        print(f'{call} returned: {parameter}')
+                        clog.debug("%s returned: %s", call, parameter)
                 else:
                     processed.append(parameter)
 
-            print(f'{function} calling with:')
-            pprint(processed)
+            clog.debug("%s calling with: %s", function, processed)
             data = getattr(client,function)(*processed)
             return data
         else:
-            print(f"Error [{function}] doesn't exist")
+            clog.error(f"Error [{function}] doesn't exist")
+
+
+    def icon_path(self,icon):
+        """
+        Resolve an icon name to a file inside the static folder. Icons are relative to `http/static/icons/` but built in icons point into `http/static/site/`.
+
+        :param icon: Icon value from source config
+        :return: returns full path to icon file or None if it does not exist or is outside the static folder
+        """
+        static=os.path.realpath(self.app.static_folder)
+        path=os.path.realpath(os.path.join(static,"icons",icon))
+        if not path.startswith(static+os.sep) or not os.path.isfile(path):
+            return None
+        return path
+
+
+    def icon_hash(self,path):
+        """
+        Hash of icon file contents used to key the on disk cache. Hashes are remembered until the file modification time or size changes so the file is only read again when it is edited.
+
+        :param path: Full path to icon file
+        :return: returns hex digest of file contents
+        """
+        stat=os.stat(path)
+        if path in self.icon_hashes and self.icon_hashes[path][0] == (stat.st_mtime_ns,stat.st_size):
+            return self.icon_hashes[path][1]
+
+        with open(path, 'rb') as iconfile:
+            digest=hashlib.sha1(iconfile.read()).hexdigest()
+        self.icon_hashes[path]=((stat.st_mtime_ns,stat.st_size),digest)
+        return digest
+
+
+    def icon_variant(self,path,size):
+        """
+        Get resized version of an icon, generating it in the cache folder if it does not exist yet. Images are only ever scaled down and keep their aspect ratio.
+
+        :param path: Full path to icon file
+        :param size: Tuple of max width and height for the icon
+        :return: returns path to resized icon in cache
+        """
+        ext=self.icon_format
+        if ext is None:
+            ext="jpg" if os.path.splitext(path)[1].lower() in [".jpg",".jpeg"] else "png"
+        cached=os.path.join(self.icon_cache,f'{self.icon_hash(path)}-{size[0]}x{size[1]}.{ext}')
+        if os.path.exists(cached):
+            return cached
+
+        os.makedirs(self.icon_cache, exist_ok=True)
+        with Image.open(path) as image:
+            image.thumbnail(size, Image.LANCZOS)
+            if ext == "jpg" and image.mode != "RGB":
+                image=image.convert("RGB")
+            # Write to a unique temp file first so requests running at the same time never read or mix partial images
+            handle, temp = tempfile.mkstemp(dir=self.icon_cache, suffix=".tmp")
+            try:
+                with os.fdopen(handle, 'wb') as tempfile_out:
+                    image.save(tempfile_out, format="JPEG" if ext == "jpg" else ext.upper())
+                os.replace(temp,cached)
+            except Exception:
+                os.unlink(temp)
+                raise
+        return cached
+
+
+    def icon_html(self,icon,source):
+        """
+        Build img tag for an icon. When resizing is available the image is given a srcset of right sized variants so large source images are not sent to clients.
+
+        :param icon: Icon value from source config
+        :param source: Source identifier for the img attribute
+        :return: returns generated HTML as string
+        """
+        path=self.icon_path(icon) if self.icon_resize else None
+        if path is None:
+            return f'<img src="/static/icons/{icon}" source="{source}">'
+
+        digest=self.icon_hash(path)
+        urls={}
+        for density, size in icon_sizes.items():
+            urls[density]=f'/icon?src={quote(icon)}&w={size[0]}&h={size[1]}&v={digest}'
+        srcset=", ".join(f'{url} {density}' for density, url in urls.items())
+        return f'<img src="{urls["1x"]}" srcset="{srcset}" source="{source}">'
 
 
 # Endpoints
@@ -462,11 +1556,27 @@ function system(event) {{
 		// Do Nothing
 	}});
 }};
+
+function health() {{
+	fetch("/health").then((response) => response.json()).then((devices) => {{
+		let output="";
+		for (const [key, device] of Object.entries(devices)) {{
+			const title=device.error ? device.error.replace(/"/g,"&quot;") : "";
+			output+=`<span class="device ${{device.state}}" title="${{title}}">${{device.name}}</span>`;
+		}}
+		document.getElementById("health").innerHTML=output;
+	}}).catch(() => {{
+		document.getElementById("health").innerHTML='<span class="device down">Video Route</span>';
+	}});
+}};
+window.addEventListener("load", health);
+setInterval(health, 5000);
 </script>
 <link rel="stylesheet" type="text/css" href="/static/site/style.css" ></style>
 <link rel="stylesheet" type="text/css" href="/static/user.css" ></style>
 </head>
 <body>
+<div class="health" id="health"></div>
 <div class="sources" >
 '''
         output+=self.build_sources(self.config["sources"])
@@ -543,7 +1653,7 @@ function system(event) {{
                     if "icon" in value:
 
                         output+=f'''
-                <div onclick="system(event)" class="button group-icon"><img src="/static/icons/{value["icon"]}" source="{prefix+key}"></div>
+                <div onclick="system(event)" class="button group-icon">{self.icon_html(value["icon"],prefix+key)}</div>
             '''
                     # Recursive call to build child sources
                     output+=self.build_sources(value["sources"],prefix+key+"|")
@@ -577,7 +1687,7 @@ function system(event) {{
             if "icon" in value:
                     # Provided Image
                     output+=f'''
-        <img src="/static/icons/{value["icon"]}" source="{prefix+key}">
+        {self.icon_html(value["icon"],prefix+key)}
     '''
             # Use div to group test if description provided
             if "description" in value:
@@ -609,13 +1719,84 @@ function system(event) {{
         :return: returns generic response for HTTP
         """
         data = request.get_json()
-        pprint(data)
+        log.debug("Request: %s", data)
+        if self.recorder is not None and "source" in data:
+            self.recorder.event(s=data["source"])
         if "source" in data:
             self.parse_sources(data['source'], self.config["sources"])
 
         return "sure"
 
 
+    def web_icon(self):
+        """
+        Endpoint handler for resized icons. The `v` parameter is the source file hash and is only used to make URLs change when an icon is edited so they can be cached by clients.
+
+        :return: returns resized icon or original icon if it can't be resized
+        """
+        icon=request.args.get("src", "")
+        path=self.icon_path(icon)
+        if path is None:
+            return Response("Icon not found", status=404)
+
+        size=(request.args.get("w", 0, type=int), request.args.get("h", 0, type=int))
+        if size not in icon_sizes.values() or not self.icon_resize:
+            return send_file(path)
+
+        try:
+            return send_file(self.icon_variant(path,size), max_age=31536000)
+        except Exception as e:
+            log.error(f"Error resizing icon [{icon}]:" + repr(e))
+            return send_file(path)
+
+
+    def web_agents(self):
+        """
+        Endpoint for health of remote agents
+
+        :return: returns JSON with status of each agent connection
+        """
+        return {f'{address[0]}:{address[1]}':agent.status() for address, agent in dict(self.remote_agents).items() if agent.pid == os.getpid()}
+
+
+    def web_health(self):
+        """
+        Endpoint for health of video controllers
+
+        :return: returns JSON with status of each video controller
+        """
+        status=self.health_status()
+
+        # Remote controllers use the state of their agent connection and the health the agent reports
+        for key, value in self.config["video_controllers"].items():
+            if not isinstance(value, dict) or value.get("type") != "remote":
+                continue
+            agent=self.remote_agents.get((value["ip"],int(value["port"])))
+            if agent is not None and agent.pid != os.getpid():
+                agent=None
+            remote=agent.health.get(value["controller"], {}) if agent is not None else {}
+            status[key]={
+                "name":value["name"] if "name" in value else key,
+                "state":agent.controller_state(value["controller"]) if agent is not None else "unknown",
+                "since":remote.get("since"),
+                "error":"Agent not connected" if agent is not None and agent.state == "down" else remote.get("error"),
+                "queued":agent.queue.qsize() if agent is not None else 0,
+                "dropped":agent.dropped.get(value["controller"],0) if agent is not None else 0
+            }
+        return status
+
+
+    def health_status(self):
+        """
+        Status of health probes for local video controllers, also sent to connected instances when running as an agent
+
+        :return: returns dict of status for each video controller
+        """
+        with self.health_lock:
+            health=dict(self.health)
+        return {key:value.status() for key, value in health.items()}
+
+
     def parse_sources(self, source, config):
         """
         Parses delimited source command identifier to run associated commands. Recursively calls self for nested sources.
@@ -625,15 +1806,53 @@ function system(event) {{
         :return: returns nothing
         """
 
-        if source.split("|")[0] in config:
-            for key, value in config[source.split("|")[0]].items():
+        # Use precompiled commands if loaded from a compiled config
+        if self.dispatch is not None:
+            resolved=self.dispatch.get(source, [])
+        else:
+            resolved=resolve_source(source, config, self.config["video_controllers"])
+
+        for key, value in resolved:
+            self.run_controller(key,value)
+
+
+    def run_controller(self, key, cmds):
+        """
+        Send commands to a video controller unless its health probe says it is down. Marks the controller as down if the device could not be reached, errors from individual commands don't change its state.
+
+        :param key: Key of the video controller in the config
+        :param cmds: Commands to send
+        :return: returns False if commands were not sent or the device could not be reached
+        """
+        health=self.health.get(key)
+        if health is not None and not health.allow(cmds):
+            return False
+
+        if self.send_controller(key,cmds) is False:
+            if health is not None:
+                health.down("Could not reach device")
+            return False
+        return True
+
 
-                if isinstance(value, dict):
-                    self.parse_sources(source[len(source.split("|")[0])+1:], value)
+    def send_controller(self, key, cmds):
+        """
+        Send commands to a video controller and record how long it waited for other commands to the same controller and how long it took to run.
 
-                if key in self.config["video_controllers"] and self.config["video_controllers"][key]["type"] in self.video_controllers:
-                    print(f'Configuring: {key}')
-                    self.video_controllers[self.config["video_controllers"][key]["type"]](value,self.config["video_controllers"][key])
+        :param key: Key of the video controller in the config
+        :param cmds: Commands to send
+        :return: returns result of the controller function
+        """
+        log.debug("Configuring: %s", key)
+        config=self.config["video_controllers"][key]
+        queued=time.monotonic()
+        with self.controller_lock(key):
+            start=time.monotonic()
+            result=self.video_controllers[config["type"]](cmds,config)
+            end=time.monotonic()
+        if self.recorder is not None:
+            self.recorder.event(c=key,n=len(cmds),w=round(start-queued,4),d=round(end-start,4))
+        return result
 
 
 # ------ Async Server Handler ------
@@ -649,7 +1868,7 @@ async def asyncLoop():
 
     :return: returns nothing
     """
-    print('Blocking main loop')
+    log.info('Blocking main loop')
     global loop_state
     while loop_state:
         await asyncio.sleep(1)
@@ -661,7 +1880,7 @@ def exit_handler(sig, frame):
 
     :return: returns nothing"""
     global loop_state
-    print('You pressed Ctrl+C!')
+    log.info('You pressed Ctrl+C!')
     loop_state = False
     server.stop()
 
@@ -680,7 +1899,7 @@ async def startWeb(args):
 
     # Setup CTRL-C signal to end programm
     signal.signal(signal.SIGINT, exit_handler)
-    print('Press Ctrl+C to exit program')
+    log.info('Press Ctrl+C to exit program')
 
     # Start async modules
     L = await asyncio.gather(
@@ -690,6 +1909,182 @@ async def startWeb(args):
 # ------ Async Server Handler ------
 
 
+def percentiles(values):
+    """
+    Summarize a list of times for reports.
+
+    :param values: List of times in seconds
+    :return: returns string of p50, p90, p99, and max in milliseconds
+    """
+    if not values:
+        return "none"
+    values=sorted(values)
+    def pick(p):
+        return values[min(len(values)-1,int(len(values)*p))]*1000
+    return f'p50 {pick(0.5):.1f}ms  p90 {pick(0.9):.1f}ms  p99 {pick(0.99):.1f}ms  max {values[-1]*1000:.1f}ms'
+
+
+def replay_trace(args):
+    """
+    Replay requests from a file made with --record and report how the server handled them.
+
+    Requests are sent on the same schedule as the recording divided by the speed. If a target URL is given they are sent to that server over HTTP, otherwise a server is created in this process using the config file with every video controller replaced by a mock. Mocks take as long as the controller did in the recording and the server only sends one command list at a time to each of them like real devices, which shows how requests queue up behind slow devices.
+
+    Commands the server dropped or queued for devices that are down are taken from its health status before and after the replay.
+
+    :param args: argument values from program start
+    :return: returns exit code
+    """
+    events=[]
+    try:
+        with open(args.replay, newline='') as recordfile:
+            header=json.loads(recordfile.readline())
+            if not isinstance(header, dict) or header.get("v") != 1:
+                raise ValueError("Bad header")
+            for line in recordfile:
+                if line.strip():
+                    event=json.loads(line)
+                    if not isinstance(event, dict) or not isinstance(event.get("t"), (int, float)):
+                        raise ValueError("Bad event")
+                    if "s" in event and not isinstance(event["s"], str):
+                        raise ValueError("Bad request event")
+                    if "c" in event and (not isinstance(event["c"], str) or not isinstance(event.get("d"), (int, float))):
+                        raise ValueError("Bad controller event")
+                    events.append(event)
+    except ValueError as e:
+        print(f"Unknown recording format in [{args.replay}]")
+        return 1
+
+    requests=[event for event in events if "s" in event]
+    if not requests:
+        print(f"No requests recorded in [{args.replay}]")
+        return 1
+
+    # Average time each controller took in the recording
+    durations={}
+    for event in events:
+        if "c" in event:
+            durations.setdefault(event["c"],[]).append(event["d"])
+    durations={key:sum(value)/len(value) for key, value in durations.items()}
+
+    lock=threading.Lock()
+    stats={"in_flight":0,"max_in_flight":0,"errors":0,"latency":[],"late":[]}
+    devices={}
+
+    if args.target is not None:
+        from urllib import request as request_url
+        url=args.target.rstrip("/")+"/system"
+        def post(source):
+            req=request_url.Request(url, data=json.dumps({"source":source}).encode(), headers={"Content-Type":"application/json"})
+            with request_url.urlopen(req, timeout=30) as resp:
+                return resp.status
+        def health():
+            try:
+                with request_url.urlopen(args.target.rstrip("/")+"/health", timeout=30) as resp:
+                    return json.loads(resp.read())
+            except Exception as e:
+                print(f"Could not read health from [{args.target}]: {e!r}")
+                return {}
+    else:
+        args.reset_skip=True
+        server=WebInterface(args)
+        keys={id(value):key for key, value in server.config["video_controllers"].items()}
+        for key in server.config["video_controllers"]:
+            devices[key]={"waiting":0,"max_waiting":0,"calls":0,"commands":0,"wait":[]}
+
+        # Count requests waiting on the server's per device send lock
+        waits=threading.local()
+        send_controller=server.send_controller
+        def tracked_send(key,cmds):
+            waits.queued=time.monotonic()
+            with lock:
+                devices[key]["waiting"]+=1
+                devices[key]["max_waiting"]=max(devices[key]["max_waiting"],devices[key]["waiting"])
+            return send_controller(key,cmds)
+        server.send_controller=tracked_send
+
+        def mock(cmds,config):
+            device=devices[keys[id(config)]]
+            with lock:
+                device["waiting"]-=1
+                device["calls"]+=1
+                device["commands"]+=len(cmds)
+                device["wait"].append(time.monotonic()-waits.queued)
+            time.sleep(durations.get(keys[id(config)],args.mock_delay))
+
+        for controller_type in server.video_controllers:
+            server.video_controllers[controller_type]=mock
+        client=server.app.test_client
+
+        def post(source):
+            return client().post("/system", json={"source":source}).status_code
+        health=server.web_health
+
+    def send(source,scheduled):
+        start=time.monotonic()
+        with lock:
+            stats["late"].append(start-scheduled)
+            stats["in_flight"]+=1
+            stats["max_in_flight"]=max(stats["max_in_flight"],stats["in_flight"])
+        try:
+            if post(source) != 200:
+                raise Exception("Bad response")
+        except Exception as e:
+            with lock:
+                stats["errors"]+=1
+        with lock:
+            stats["in_flight"]-=1
+            stats["latency"].append(time.monotonic()-start)
+
+    print(f"Replaying {len(requests)} requests from [{args.replay}] at {args.speed}x against {args.target if args.target is not None else 'mock controllers'}")
+    health_start=health()
+    threads=[]
+    start=time.monotonic()
+    for event in requests:
+        scheduled=start+event["t"]/args.speed
+        delay=scheduled-time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        thread=threading.Thread(target=send, args=(event["s"],scheduled), daemon=True)
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    elapsed=time.monotonic()-start
+    health_end=health()
+
+    # Commands dropped during the replay and still queued at the end for each device
+    health_change={}
+    for key, status in health_end.items():
+        dropped=status.get("dropped",0)-health_start.get(key,{}).get("dropped",0)
+        if dropped or status.get("queued"):
+            health_change[key]=(dropped,status.get("queued",0),status.get("state"))
+
+    print(f"Finished in {elapsed:.2f}s ({requests[-1]['t']:.2f}s recorded)")
+    print(f"Requests: {len(requests)}  errors: {stats['errors']}  dropped: {sum(value[0] for value in health_change.values())}  queued: {sum(value[1] for value in health_change.values())}  max in flight: {stats['max_in_flight']}")
+    print(f"Latency: {percentiles(stats['latency'])}")
+    print(f"Send delay: {percentiles(stats['late'])}")
+    for key, device in devices.items():
+        if device["calls"]:
+            print(f"[{key}] calls: {device['calls']}  commands: {device['commands']}  max queued: {device['max_waiting']}  wait: {percentiles(device['wait'])}")
+    for key, (dropped, queued, state) in health_change.items():
+        print(f"[{key}] {state}  dropped: {dropped}  queued: {queued}")
+    return 0
+
+
+def positive_float(value):
+    """
+    Argument type for numbers that must be greater than zero
+
+    :param value: Argument string
+    :return: returns value as float
+    """
+    number=float(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError(f"must be greater than 0, got [{value}]")
+    return number
+
+
 def main():
     """
     Execute CLI start and process parameters
@@ -701,14 +2096,39 @@ def main():
                     prog="video-route",
                     description='Web page remote for control video processors',
                     epilog='')
-    parser.add_argument('-i', '--ip', help="Web server listening IP", default="0.0.0.0")
+    parser.add_argument('-i', '--ip', help="Listening IP, defaults to 0.0.0.0 for the web server and 127.0.0.1 for agents", default=None)
     parser.add_argument('-p', '--port', help="Web server listening port", default="5000")
     parser.add_argument('-c', '--config', help="JSON config file", default=None)
     parser.add_argument('-r', '--reset-skip', help="Do not re-initialize hardware", action='store_true')
+    parser.add_argument('-w', '--icon-webp', help="Serve resized icons as WebP", action='store_true')
+    parser.add_argument('--icon-cache', help="Folder to store resized icons in", default=None)
+    parser.add_argument('-a', '--agent', help="Run as agent for remote controllers on --ip and --port", action='store_true')
+    parser.add_argument('-k', '--agent-key', help="Shared key for agent connections, can also be set with the VIDEO_ROUTE_AGENT_KEY environment variable", default=None)
+    parser.add_argument('-K', '--agent-key-file', help="File to read shared key for agent connections from", default=None)
+    parser.add_argument('--check', help="Check config file for errors and exit", action='store_true')
+    parser.add_argument('--compile', help="Check config file and write compiled config to this path", default=None)
+    parser.add_argument('-l', '--log-level', help="Log level. Send SIGUSR1 to toggle DEBUG while running", type=str.upper, choices=["DEBUG","INFO","WARNING","ERROR"], default="INFO")
+    parser.add_argument('-j', '--log-json', help="Output logs as JSON", action='store_true')
+    parser.add_argument('--probe-interval', help="Seconds between device health checks, 0 to disable", type=float, default=10)
+    parser.add_argument('--record', help="Record requests and commands to this file for --replay", default=None)
+    parser.add_argument('--replay', help="Replay requests from a recording and report latency", default=None)
+    parser.add_argument('--speed', help="Speed multiplier for --replay", type=positive_float, default=1.0)
+    parser.add_argument('--target', help="URL of server for --replay, uses mock controllers in this process if not provided", default=None)
+    parser.add_argument('--mock-delay', help="Seconds mock controllers take for controllers with no recorded commands", type=float, default=0)
     parser.add_argument('-S', '--serial-names', help="List serial port names", action='store_true')
     parser.add_argument('other', help="", default=None, nargs=argparse.REMAINDER)
     args = parser.parse_args()
 
+    setup_logging(args.log_level,args.log_json)
+    signal.signal(signal.SIGUSR1, toggle_debug)
+
+    # Agent key from file or environment keeps it out of the process list
+    if args.agent_key is None and args.agent_key_file is not None:
+        with open(args.agent_key_file) as keyfile:
+            args.agent_key=keyfile.read().strip()
+    if args.agent_key is None:
+        args.agent_key=os.environ.get("VIDEO_ROUTE_AGENT_KEY")
+
 
     # Print out information for all connected serial devices and exit
     if args.serial_names:
@@ -725,7 +2145,54 @@ def main():
             sys.exit(1)
 
 
+    # Validate config and optionally write compiled version then exit
+    if args.check or args.compile is not None:
+        if args.config is None or not os.path.exists(args.config):
+            print("A JSON config file must be provided with -c")
+            sys.exit(1)
+        with open(args.config, newline='') as jsonfile:
+            try:
+                config=json.load(jsonfile)
+            except json.JSONDecodeError as e:
+                print(f"Config error [{args.config}] {e}")
+                sys.exit(1)
+
+        errors=check_config(config)
+        for error in errors:
+            print(f"Config error {error}")
+        if errors:
+            sys.exit(1)
+        print(f"Config [{args.config}] is valid")
+
+        if args.compile is not None:
+            with open(args.compile, 'wb') as compiledfile:
+                pickle.dump(compile_config(config), compiledfile)
+            print(f"Compiled config written to [{args.compile}]")
+        sys.exit(0)
+
+
+    # Load test with recorded requests
+    if args.replay is not None:
+        sys.exit(replay_trace(args))
+
+
+    # Run as agent for another instance instead of web server
+    if args.agent:
+        # Agents accept pickled messages so they must never run without a private key
+        if not args.agent_key:
+            print("Agent mode requires a private shared key set with -k, -K, or VIDEO_ROUTE_AGENT_KEY")
+            sys.exit(1)
+        if args.ip is None:
+            args.ip="127.0.0.1"
+        try:
+            WebInterface(args).serve_agent()
+        except KeyboardInterrupt:
+            sys.exit(0)
+
+
     # Run web server
+    if args.ip is None:
+        args.ip="0.0.0.0"
     asyncio.run(startWeb(args))
     sys.exit(0)
 